@@ -17,103 +17,190 @@
 # GNU General Public License for more details.
 
 import os
+import re
+import sys
+import stat
+import locale
+import bisect
+import hashlib
+import logging
 # mapping from Hatari config variable name to type id (Bool, Int, String)
 from conftypes import conftypes
 
+log = logging.getLogger(__name__)
+
+# intern() is a builtin in Python 2
+_intern = getattr(sys, "intern", None) or intern
+# os.replace() is missing from Python 2, there rename() replaces
+# existing files on POSIX
+_replace = getattr(os, "replace", None) or os.rename
+
 # ------------------------------------------------------
 # Helper functions for type safe Hatari configuration variable access.
 # Map booleans, integers and strings to Python types, and back to strings.
 
+# Python value type -> (Hatari config variable type, conversion to text)
+_ENCODERS = {
+    bool: ("Bool", lambda value: value and "TRUE" or "FALSE"),
+    int: ("Int", str),
+    type(None): ("String", lambda value: "")
+}
+_STRING_ENCODER = ("String", lambda value: value)
+
 def value_to_text(key, value):
     "value_to_text(key, value) -> text, convert Python type to string"
-    assert(key in conftypes)
-    valtype = type(value)
-    if valtype == bool:
-        assert(conftypes[key] == "Bool")
-        if value:
-            text = "TRUE"
-        else:
-            text = "FALSE"
-    elif valtype == int:
-        assert(conftypes[key] == "Int")
-        text = str(value)
-    else:
-        assert(conftypes[key] == "String")
-        if value == None:
-            text = ""
-        else:
-            text = value
-    return text
+    valtype, encode = _ENCODERS.get(type(value), _STRING_ENCODER)
+    assert(conftypes.get(key) == valtype)
+    return encode(value)
+
+# INI file boolean value spellings
+_BOOLS = {
+    "TRUE": True, "True": True, "true": True,
+    "FALSE": False, "False": False, "false": False
+}
+
+# integer value characters, str.isdigit() accepts
+# also non-ASCII digits that int() rejects
+_DIGITS = "0123456789"
 
 def text_to_value(text):
     "text_to_value(text) -> value, convert INI file values to real types"
     # bool?
-    upper = text.upper()
-    if upper == "FALSE":
-        value = False
-    elif upper == "TRUE":
-        value = True
+    value = _BOOLS.get(text)
+    if value is not None:
+        return value
+    # integer?
+    if text[:1] in ("-", "+"):
+        digits = text[1:]
     else:
-        try:
-            # integer?
-            value = int(text)
-        except ValueError:
-            # string
-            value = text
-    return value
+        digits = text
+    if digits and not digits.strip(_DIGITS):
+        return int(text)
+    # string
+    return text
 
 
 # ------------------------------------------------------
 # Handle INI style configuration files as used by Hatari
 
+# leafdir -> found user config subdirectory
+_userpaths = {}
+
+def _find_userpath(leafdir):
+    "_find_userpath(leafdir) -> HOME, CWD or their subdir, subdir cached per process"
+    if leafdir in _userpaths:
+        return _userpaths[leafdir]
+    # user's hatari.cfg can be in home or current work dir,
+    # current dir is used only if $HOME fails
+    for path in (os.getenv("HOME"), os.getenv("HOMEPATH"), os.getcwd()):
+        if path and os.path.isdir(path):
+            if leafdir:
+                hpath = os.path.join(path, leafdir)
+                if os.path.isdir(hpath):
+                    # fallbacks aren't cached, subdir may be created later
+                    _userpaths[leafdir] = hpath
+                    return hpath
+            return path
+    return None
+
+# "[section]" header lines (with optional trailing comment), other lines
+# starting with '[' (taken whole as section names), "key = value" lines
+# and other lines, lines starting with '#' or ';' are comments
+_LINE_RE = re.compile(r'''^[ \t]*(?:
+    (\[[^\]\n]*\])[ \t]*(?:[#;].*?)?          # section header
+  | (\[.*?)                                  # unusual section header
+  | ([^#;\[=\s][^=\n]*?)[ \t]*=[ \t]*(.*?)    # key = value
+  | ([^#;\s].*?)                             # invalid line
+)[ \t\r]*$''', re.M | re.X)
+
+# marker for missing sections and keys in dict.get() lookups
+_MISSING = object()
+
+def _copy_sections(sections):
+    "_copy_sections(sections) -> copy of sections that can be modified separately"
+    copy = {}
+    for name, seckeys in sections.items():
+        copy[name] = seckeys.copy()
+    return copy
+
+def _get_file_stamp(path):
+    "_get_file_stamp(path) -> (mtime in ns, size) for detecting file changes"
+    info = os.stat(path)
+    # Python 2 has only float mtime
+    mtime = getattr(info, "st_mtime_ns", None) or int(info.st_mtime * 1e9)
+    return (mtime, info.st_size)
+
+def _encode_text(text):
+    "_encode_text(text) -> text encoded like text mode files would do it"
+    # newline translation text mode would do, e.g. CRLF on Windows
+    if os.linesep != "\n":
+        text = text.replace("\n", os.linesep)
+    if isinstance(text, bytes):
+        # Python 2 str
+        return text
+    return text.encode(locale.getpreferredencoding(False))
+
 class ConfigStore:
-    def __init__(self, userconfdir, defaults = {}, miss_is_error = True):
-        "ConfigStore(userconfdir, fgfile[,defaults,miss_is_error])"
+    # path -> ((mtime, size), sections) of already parsed config files
+    _cache = {}
+
+    def __init__(self, userconfdir, defaults = {}, miss_is_error = True, use_cache = True):
+        "ConfigStore(userconfdir, fgfile[,defaults,miss_is_error,use_cache])"
         self.defaults = defaults
+        self.use_cache = use_cache
         self.userpath = self._get_full_userpath(userconfdir)
-        self.miss_is_error = miss_is_error
+        # set(section,key,value), set given key to given section.
+        # Missing section/key handling is fixed at construction
+        if miss_is_error:
+            self.set = self._set_strict
+        else:
+            self.set = self._set_lax
+        # (section, key) pairs set to a new value since loading
+        self._dirty = set()
+        # path -> ((mtime, size), MD5) of read/written config files
+        self._disk_md5 = {}
+        # (sorted section names, section -> sorted keys) for writing
+        self._order = None
+        # (section, key) -> value converted to text for writing
+        self._encoded = {}
     
     def _get_full_userpath(self, leafdir):
         "get_userpath(leafdir) -> config file default save path from HOME, CWD or their subdir"
-        # user's hatari.cfg can be in home or current work dir,
-        # current dir is used only if $HOME fails
-        for path in (os.getenv("HOME"), os.getenv("HOMEPATH"), os.getcwd()):
-            if path and os.path.exists(path) and os.path.isdir(path):
-                if leafdir:
-                    hpath = "%s%c%s" % (path, os.path.sep, leafdir)
-                    if os.path.exists(hpath) and os.path.isdir(hpath):
-                        return hpath
-                return path
-        return None
+        return _find_userpath(leafdir)
 
     def get_filepath(self, filename):
         "get_filepath(filename) -> return correct full path to config file"
         # user config has preference over system one
         for path in (self.userpath, os.getenv("HATARI_SYSTEM_CONFDIR")):
             if path:
-                file = "%s%c%s" % (path, os.path.sep, filename)
+                file = os.path.join(path, filename)
                 if os.path.isfile(file):
                     return file
         # writing needs path name although it's missing for reading
-        return "%s%c%s" % (self.userpath, os.path.sep, filename)
+        return os.path.join(self.userpath, filename)
     
     def load(self, path):
         "load(path) -> load given configuration file"
         if os.path.isfile(path):
-            sections = self._read(path)
+            sections = self._read_cached(path)
             if sections:
                 self.sections = sections
             else:
-                print("ERROR: configuration file loading failed!")
+                log.error("configuration file loading failed!")
                 return
         else:
-            print("WARNING: configuration file missing!")
+            log.warning("configuration file missing!")
             if self.defaults:
-                print("-> using dummy 'defaults'.")
+                log.warning("using dummy 'defaults' instead.")
             self.sections = self.defaults
         self.path = path
         self.cfgfile = os.path.basename(path)
-        self.original = self.get_checkpoint()
+        # loaded values of variables changed since loading,
+        # recorded on first change instead of copying everything
+        self.original = {}
+        self._dirty = set()
+        self._order = None
+        self._encoded = {}
         self.changed = False
 
     def is_loaded(self):
@@ -126,81 +213,110 @@ class ConfigStore:
         "get_path() -> configuration file path"
         return self.path
     
+    def _read_cached(self, path):
+        "_read_cached(path) -> copy of sections, parse file only if it changed"
+        if not self.use_cache:
+            return self._read(path)
+        stamp = _get_file_stamp(path)
+        cached = ConfigStore._cache.get(path)
+        if cached and cached[0] == stamp:
+            sections = cached[1]
+        else:
+            sections = self._read(path)
+            ConfigStore._cache[path] = (stamp, sections)
+        return _copy_sections(sections)
+
     def _read(self, path):
         "_read(path) -> (all keys, section2key mappings)"
-        print("Reading configuration file '%s'..." % path)
-        config = open(path, "r")
-        if not config:
-            return ({}, {})
+        log.info("Reading configuration file '%s'...", path)
+        with open(path, "r") as config:
+            data = config.read()
+        sections = {}
+        # keys before first section header go to "[_orphans_]"
         name = "[_orphans_]"
         seckeys = {}
-        sections = {}
-        for line in config.readlines():
-            line = line.strip()
-            if not line or line[0] == '#':
-                continue
-            if line[0] == '[':
-                if line in sections:
-                    print("WARNING: section '%s' twice in configuration" % line)
+        for match in _LINE_RE.finditer(data):
+            header, rawheader, key, text, invalid = match.groups()
+            if rawheader is not None:
+                header = rawheader
+            if key is not None:
+                # section and key names are a fixed vocabulary, so intern them
+                # to share them between instances and speed up their lookups
+                seckeys[_intern(key)] = text_to_value(text)
+            elif header is not None:
                 if seckeys:
                     sections[name] = seckeys
                     seckeys = {}
-                name = line
-                continue
-            if line.find('=') < 0:
-                print("WARNING: line without key=value pair:\n%s" % line)
-                continue
-            key, text = [string.strip() for string in line.split('=')]
-            seckeys[key] = text_to_value(text)
+                name = _intern(header)
+                if name in sections:
+                    log.warning("section '%s' twice in configuration", name)
+            else:
+                log.warning("line without key=value pair:\n%s", invalid)
         if seckeys:
             sections[name] = seckeys
         return sections
 
     def get_checkpoint(self):
         "get_checkpoint() -> checkpoint, get the state of variables at this point"
-        checkpoint = {}
-        for section in self.sections.keys():
-            checkpoint[section] = self.sections[section].copy()
-        return checkpoint
+        return _copy_sections(self.sections)
     
     def get_checkpoint_changes(self, checkpoint):
-        "get_checkpoint_changes() -> list of (key, value) pairs for later changes"
-        changed = []
+        "get_checkpoint_changes() -> generator of (key, value) pairs for later changes"
         if not self.changed:
-            return changed
-        for section in self.sections.keys():
-            if section not in checkpoint:
-                for key, value in self.sections[section].items():
-                    changed.append((key, value))
+            return
+        # only variables set after loading can differ from the checkpoint
+        for section, key in sorted(self._dirty):
+            value = self.sections.get(section, {}).get(key, _MISSING)
+            if value is _MISSING:
+                # not in the current (reverted) configuration
                 continue
-            for key, value in self.sections[section].items():                    
-                if (key not in checkpoint[section] or
-                value != checkpoint[section][key]):
-                    text = value_to_text(key, value)
-                    changed.append(("%s.%s" % (section, key), text))
-        return changed
+            if checkpoint.get(section, {}).get(key, _MISSING) == value:
+                continue
+            yield ("%s.%s" % (section, key), value_to_text(key, value))
     
     def revert_to_checkpoint(self, checkpoint):
         "revert_to_checkpoint(checkpoint), revert to given checkpoint"
         self.sections = checkpoint
+        self._order = None
+        self._encoded = {}
 
     def get(self, section, key):
         return self.sections[section][key]
 
-    def set(self, section, key, value):
-        "set(section,key,value), set given key to given section"
-        if section not in self.sections:
-            if self.miss_is_error:
-                raise AttributeError("no section '%s'" % section)
-            self.sections[section] = {}
-        if key not in self.sections[section]:
-            if self.miss_is_error:
-                raise AttributeError("key '%s' not in section '%s'" % (key, section))
-            self.sections[section][key] = value
+    def _set_strict(self, section, key, value):
+        "_set_strict(section,key,value), set given existing key in given section"
+        seckeys = self.sections.get(section)
+        if seckeys is None:
+            raise AttributeError("no section '%s'" % section)
+        old = seckeys.get(key, _MISSING)
+        if old is _MISSING:
+            raise AttributeError("key '%s' not in section '%s'" % (key, section))
+        if old != value:
+            if (section, key) not in self._dirty:
+                self.original.setdefault(section, {})[key] = old
+                self._dirty.add((section, key))
             self.changed = True
-        elif self.sections[section][key] != value:
+            self._encoded.pop((section, key), None)
+            seckeys[key] = value
+
+    def _set_lax(self, section, key, value):
+        "_set_lax(section,key,value), set given key to given section, add if missing"
+        seckeys = self.sections.get(section)
+        if seckeys is None:
+            section = _intern(section)
+            seckeys = self.sections[section] = {}
+            if self._order:
+                bisect.insort(self._order[0], section)
+                self._order[1][section] = []
+        if key not in seckeys:
+            key = _intern(key)
+            seckeys[key] = value
+            if self._order:
+                bisect.insort(self._order[1][section], key)
+            self._dirty.add((section, key))
             self.changed = True
-        self.sections[section][key] = value
+            return
+        self._set_strict(section, key, value)
         
     def is_changed(self):
         "is_changed() -> True if current configuration is changed"
@@ -208,43 +324,108 @@ class ConfigStore:
 
     def get_changes(self):
         "get_changes(), return (key, value) list for each changed config option"
-        return self.get_checkpoint_changes(self.original)
+        return list(self.get_checkpoint_changes(self.original))
     
+    def _get_order(self):
+        "_get_order() -> (sorted section names, section -> sorted keys mapping)"
+        if not self._order:
+            keys = {}
+            for name, section in self.sections.items():
+                keys[name] = sorted(section.keys())
+            self._order = (sorted(self.sections.keys()), keys)
+        return self._order
+
+    def _get_text(self):
+        "_get_text() -> current configuration as INI file text"
+        sections, keys = self._get_order()
+        encoded = self._encoded
+        lines = []
+        for name in sections:
+            lines.append("%s\n" % name)
+            seckeys = self.sections[name]
+            for key in keys[name]:
+                text = encoded.get((name, key))
+                if text is None:
+                    text = encoded[(name, key)] = value_to_text(key, seckeys[key])
+                lines.append("%s = %s\n" % (key, text))
+            lines.append("\n")
+        return "".join(lines)
+
     def write(self, fileobj):
         "write(fileobj), write current configuration to given file object"
-        sections = list(self.sections.keys())
-        sections.sort()
-        for name in sections:
-            fileobj.write("%s\n" % name)
-            keys = list(self.sections[name].keys())
-            keys.sort()
-            for key in keys:
-                value = value_to_text(key, self.sections[name][key])
-                fileobj.write("%s = %s\n" % (key, value))
-            fileobj.write("\n")
+        fileobj.write(self._get_text())
+
+    def _get_file_md5(self, path):
+        "_get_file_md5(path) -> MD5 digest of given file contents, None if it's not readable"
+        try:
+            stamp = _get_file_stamp(path)
+            cached = self._disk_md5.get(path)
+            if cached and cached[0] == stamp:
+                return cached[1]
+            with open(path, "rb") as fileobj:
+                digest = hashlib.md5(fileobj.read()).digest()
+        except (IOError, OSError):
+            return None
+        self._disk_md5[path] = (stamp, digest)
+        return digest
+
+    def _set_file_md5(self, path, digest):
+        "_set_file_md5(path, digest), remember MD5 digest of just written file"
+        self._disk_md5[path] = (_get_file_stamp(path), digest)
+
+    def _write_file(self, path, data):
+        "_write_file(path, data) -> True if given (encoded) data replaced given file"
+        # write to a temporary file first so that interrupted
+        # saving doesn't leave behind a truncated config file,
+        # next to symlink target so that the link is preserved
+        path = os.path.realpath(path)
+        tmppath = path + ".tmp"
+        try:
+            fileobj = open(tmppath, "wb")
+        except (IOError, OSError):
+            # e.g. writable file in non-writable (system config) directory
+            log.info("can't create '%s', overwriting '%s' in place", tmppath, path)
+            try:
+                with open(path, "wb") as fileobj:
+                    fileobj.write(data)
+            except (IOError, OSError):
+                return False
+            return True
+        try:
+            with fileobj:
+                fileobj.write(data)
+            if os.path.exists(path):
+                os.chmod(tmppath, stat.S_IMODE(os.stat(path).st_mode))
+            _replace(tmppath, path)
+        except (IOError, OSError):
+            if os.path.exists(tmppath):
+                os.remove(tmppath)
+            return False
+        return True
 
     def save(self):
         "save() -> path, if configuration changed, save it"
         if not self.changed:
-            print("No configuration changes to save, skipping")
+            log.info("No configuration changes to save, skipping")
             return None
-        fileobj = None
-        if self.path:
-            try:
-                fileobj = open(self.path, "w")
-            except:
-                pass
-        if not fileobj:
-            print("WARNING: non-existing/writable configuration file, creating a new one...")
+        data = _encode_text(self._get_text())
+        digest = hashlib.md5(data).digest()
+        if self.path and self._get_file_md5(self.path) == digest:
+            log.info("No effective configuration changes to save, skipping")
+            self.changed = False
+            return self.path
+        if not (self.path and self._write_file(self.path, data)):
+            log.warning("non-existing/writable configuration file, creating a new one...")
             if not os.path.exists(self.userpath):
                 os.makedirs(self.userpath)
-            self.path = "%s%c%s" % (self.userpath, os.path.sep, self.cfgfile)
-            fileobj = open(self.path, "w")
-        if not fileobj:
-            print("ERROR: opening '%s' for saving failed" % self.path)
-            return None
-        self.write(fileobj)
-        print("Saved configuration file:", self.path)
+            self.path = os.path.join(self.userpath, self.cfgfile)
+            if not self._write_file(self.path, data):
+                log.error("opening '%s' for saving failed", self.path)
+                return None
+        # re-parse on next load, values' types come from the file
+        ConfigStore._cache.pop(self.path, None)
+        self._set_file_md5(self.path, digest)
+        log.info("Saved configuration file: %s", self.path)
         self.changed = False
         return self.path
     
@@ -259,12 +440,16 @@ class ConfigStore:
 
     def save_tmp(self, path):
         "save_tmp(path) -> path, save configuration to given file without selecting it"
+        data = _encode_text(self._get_text())
+        digest = hashlib.md5(data).digest()
+        if self._get_file_md5(path) == digest:
+            log.info("Temporary configuration file '%s' up to date, skipping", path)
+            return path
         if not os.path.exists(os.path.dirname(path)):
             os.makedirs(os.path.dirname(path))
-        fileobj = open(path, "w")
-        if not fileobj:
-            print("ERROR: opening '%s' for saving failed" % path)
+        if not self._write_file(path, data):
+            log.error("opening '%s' for saving failed", path)
             return None
-        self.write(fileobj)
-        print("Saved temporary configuration file:", path)
+        self._set_file_md5(path, digest)
+        log.info("Saved temporary configuration file: %s", path)
         return path
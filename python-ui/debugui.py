@@ -541,6 +541,9 @@ class HatariDebugUI:
 
 def main():
     import sys
+    import logging
+    # show config.py diagnostics like its earlier prints
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s: %(message)s")
     from hatari import Hatari
     hatariobj = Hatari()
     if len(sys.argv) > 1:
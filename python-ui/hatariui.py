@@ -19,6 +19,7 @@
 import os
 import sys
 import getopt
+import logging
 
 # use correct version of pygtk/gtk
 import pygtk
@@ -477,7 +478,7 @@ class UIActions:
             if action == "|":
                 # divider
                 continue
-            if action.find("=") >= 0:
+            if "=" in action:
                 # special keycode/string action
                 continue
             return "unrecognized action '%s'" % action
@@ -572,11 +573,9 @@ class UIActions:
         
         for action in actions:
             #print(action)
-            offset = action.find("=")
-            if offset >= 0:
+            name, sep, text = action.partition("=")
+            if sep:
                 # handle "<name>=<keycode>" action specification
-                name = action[:offset]
-                text = action[offset+1:]
                 widget = self._create_key_control(name, text)
             elif action == "|":
                 widget = gtk.SeparatorToolItem()
@@ -710,6 +709,8 @@ if no options are given, the UI uses basic controls.
 
 
 def main():
+    # show config.py diagnostics like its earlier prints
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s: %(message)s")
     info = UInfo()
     actions = UIActions()
     try: